@@ -5,15 +5,23 @@ import traceback
 import yaml
 import click
 import sys
-import re
 import os
-import uuid
+import stat
 import jinja2
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from collections import namedtuple
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from typing import Any, List, Optional, Tuple
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
 import config
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
 
 class CookbookException(Exception):
     def __init__(self, message=""):
@@ -44,74 +52,103 @@ class StepException(RecipeException):
     pass
 
 
+def _split_line(data: str) -> Tuple[Optional[str], Optional[str], str, Optional[str]]:
+    '''
+    Split a "id. (quantity) text; details" line in a single left to right pass.
+    Returns a (id, quantity, text, details) tuple; id is None when there is
+    no '.', quantity is None without a closed parenthesis and details is None
+    without a ';'.
+    '''
+    id, dot, rest = data.partition('.')
+    if not dot:
+        return None, None, data.strip(), None
+    rest = rest.lstrip()
+
+    quantity = None
+    if rest.startswith('('):
+        end = rest.find(')')
+        if end > 1:
+            quantity = rest[1:end].strip()
+            rest = rest[end + 1:]
+
+    text, semi, details = rest.partition(';')
+    return id, quantity, text.strip(), details.strip() if semi else None
+
+
 class Ingredient:
     ''' Format: id. (quantity) name; details'''
+    __slots__ = ('id', 'quantity', 'name', 'details', '_str')
+    id: str
+    quantity: str
+    name: str
+    details: Optional[str]
+    _str: Optional[str]
     
     def __init__(self, data):
-        r = re.compile('''^(?P<id>[A-Z]+\.) *(\((?P<quantity>[^)]+)\))? *(?P<name>[^;]+)? *(; *(?P<details>.*))?''')
-        m = r.match(data)
-        if not m:
+        id, quantity, name, details = _split_line(data)
+        # ids are one or more uppercase ascii letters
+        if not (id and id.isascii() and id.isalpha() and id.isupper()):
             raise IngredientException(f'invalid ingredient definition: {data!s}')
+        self.id = id
 
-        self.id = m.group('id')
-        if not self.id:
-            raise IngredientException(f'missing ingredient id: {data!s}')
-        self.id = self.id.strip('.')
-
-        self.quantity = m.group('quantity')
-        if not self.quantity:
+        if not quantity:
             raise IngredientException(f'missing ingredient quantity: {data!s}')
+        self.quantity = quantity
 
-        self.name = m.group('name')
-        if not self.name:
+        if not name:
             raise IngredientException(f'missing ingredient name: {data!s}')
+        self.name = name
 
         # details are optional 
-        self.details = m.group('details')
-        
+        self.details = details
+
+        # ingredients do not change once parsed, __str__ is computed once
+        self._str = None
 
     def __str__(self):
-        details = ""
-        if self.details:
-            details = f"; {self.details}"
-        return f'{self.id}. ({self.quantity}) {self.name}{details}'
+        if self._str is None:
+            details = f"; {self.details}" if self.details else ""
+            self._str = f'{self.id}. ({self.quantity}) {self.name}{details}'
+        return self._str
 
 
 class Step:
     ''' Format: id. (quantity list)+ action'''
+    __slots__ = ('id', 'quantities', 'action', 'details', '_str')
+    id: str
+    quantities: List[str]
+    action: str
+    details: Optional[str]
+    _str: Optional[str]
     
     def __init__(self, data):
-        r = re.compile('''^(?P<id>[0-9]+\.)? *(\((?P<quantities>[^)]+)\))? *(?P<action>[^;]+)? *(; *(?P<details>.*))?''')
-        m = r.match(data)
-        if not m:
-            raise StepException(f'***invalid step definition: {data!s}')
-
-        self.id = m.group('id')
-        if not self.id:
+        id, quantities, action, details = _split_line(data)
+        # ids are one or more ascii digits
+        if not (id and id.isascii() and id.isdigit()):
             raise StepException(f'missing step id: {data!s}')
-        self.id = self.id.strip('.')
+        self.id = id
 
         # Quantities are optional
         self.quantities = []
-        quantities = m.group('quantities')
         if quantities:
-            self.quantities = quantities #.split(',')
+            self.quantities = [q.strip() for q in quantities.split(',')]
 
-        self.action = m.group('action')
-        if not self.action:
+        if not action:
             raise StepException(f'missing step action: {data!s}')
+        self.action = action
 
         # details are optional
-        self.details = m.group('details')
+        self.details = details
+
+        # steps do not change once parsed, __str__ is computed once
+        self._str = None
 
     def __str__(self):
-        quantities = ""
-        if self.quantities:
-            quantities = f"({', '.join(self.quantities)}) "
-        details = ""
-        if self.details:
-            details = f"; {self.details}"
-        return f'{self.id}. {quantities}{self.action}{details}'
+        if self._str is None:
+            quantities = f"({', '.join(self.quantities)}) " if self.quantities else ""
+            details = f"; {self.details}" if self.details else ""
+            self._str = f'{self.id}. {quantities}{self.action}{details}'
+        return self._str
 
 
 class Recipe:
@@ -119,22 +156,28 @@ class Recipe:
     A recipe must have: title, ingredients, steps
     should have: dates, images, intro
     ''' 
+    __slots__ = ('id', 'title', 'ingredients', 'steps', 'img', 'sources', 'tags', 'groups')
+    # ids and titles come straight from yaml, e.g. an id can be an int
+    id: Any
+    title: Any
+    ingredients: List[Ingredient]
+    steps: List[Step]
+    img: str
+    sources: list
+    tags: list
+    groups: list
+
     def __init__(self, data):
-        self.id = uuid.uuid4().hex
-        self.sources = []
-        self.title = ''
         self.ingredients = []
         self.steps = []
         self.img = ""
-        self.tags = []
 
-        if 'id' in data:
-            self.id = data['id']
+        self.id = data.get('id') or os.urandom(16).hex()
 
-        if 'title' in data and data['title']:
-            self.title = data['title']
-        else:
+        title = data.get('title')
+        if not title:
             raise RecipeException('a recipe must have a title')
+        self.title = title
 
         self.ingredients = [Ingredient(i) for i in data['ingredients']]
         if not self.ingredients:
@@ -144,21 +187,64 @@ class Recipe:
         if not self.steps:
             raise RecipeException('a recipe must have one or more steps')
 
-        if 'sources' in data:
-            self.sources = data['sources']
+        self.sources = data.get('sources') or []
+        self.tags = data.get('tags') or []
+        self.groups = data.get('groups') or []
 
-        if 'tags' in data:
-            self.tags = data['tags']
 
-        if 'groups' in data and data['groups']:
-            for group in data['groups']:
-                if group in config.groups.keys():
-                    config.groups[group]['recipes'].append(self)
-        
-        config.recipes.append(self)
+# what the main process keeps of each recipe, once rendered: the metadata
+# used by the group pages, without the ingredients and steps
+RecipeSummary = namedtuple('RecipeSummary', ['id', 'title', 'tags', 'groups'])
 
 
-def process_file(file, output):
+def register_recipe(recipe):
+    '''
+    Add a recipe (or its summary) to the global recipes list and to each of
+    its known groups.
+    Done by the main process, as recipes are parsed in worker processes.
+    '''
+    for group in recipe.groups:
+        if group in config.groups:
+            config.groups[group]['recipes'].append(recipe)
+
+    config.recipes.append(recipe)
+
+
+def _link_or_copy(source, destination):
+    '''
+    Hard link source to destination, falling back to a copy when linking
+    is not possible (e.g. across filesystems).
+    '''
+    try:
+        if os.path.samefile(source, destination):
+            # e.g. rendering in the recipes directory
+            return
+        os.unlink(destination)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _is_up_to_date(target, *mtimes):
+    '''
+    Whether the target file exists and is at least as recent as all the
+    given source modification times.
+    '''
+    try:
+        target_mtime = target.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return all(target_mtime >= mtime for mtime in mtimes)
+
+
+# image files looked for next to a recipe file, in order of preference
+IMAGE_SUFFIXES = ('.png', '.jpeg')
+
+
+def process_file(file, output, image, force=False):
     """
     Process a recipe file.
 
@@ -167,23 +253,49 @@ def process_file(file, output):
     output : pathlib.Path
         The path to the directory for the rendered file.
         If we dont have an output, we will only validate each input file.
+        The directory must already exist.
+    image : str
+        The name of the recipe image, next to the recipe file, or None.
+    force : bool
+        Render the recipe even if its output is up to date.
+
+    Returns the parsed recipe.
     """
     try:
         name = file.stem
         with file.open() as f:
-            recipe = Recipe(yaml.safe_load(f))
-            source_imagefile = file.with_suffix('.png')
-            if source_imagefile.exists():
-                recipe.img = source_imagefile.name
+            data = yaml.load(f, Loader=_Loader)
+            recipe = Recipe(data)
+            if image:
+                recipe.img = image
+                source_imagefile = file.with_name(image)
             if output:
                 output_file = Path(output, name).with_suffix('.rst')
-                if not os.path.exists(output):
-                    os.makedirs(output)
-                with output_file.open('w') as out_file:
-                    recipe_to_rst(recipe, out_file)
                 if recipe.img:
-                    output_imagefile = output_file.with_suffix('.png')
-                    shutil.copyfile(source_imagefile, output_imagefile)
+                    output_imagefile = output_file.with_name(recipe.img)
+                # recipes without an id get a new one on each run, their
+                # output must be rendered again to match the group pages;
+                # adding or removing an image changes the directory mtime
+                stale = (force or not data.get('id')
+                    or not _is_up_to_date(output_file, os.fstat(f.fileno()).st_mtime,
+                        os.stat(file.parent).st_mtime, recipe_template_mtime)
+                    or (recipe.img and not _is_up_to_date(output_imagefile, source_imagefile.stat().st_mtime)))
+                if stale:
+                    with output_file.open('w') as out_file:
+                        recipe_to_rst(recipe, out_file)
+                    if recipe.img:
+                        _link_or_copy(source_imagefile, output_imagefile)
+                    # remove images published by a previous run, unless
+                    # rendering next to the recipes, where they are sources
+                    if not os.path.samefile(output, file.parent):
+                        for suffix in IMAGE_SUFFIXES:
+                            old_imagefile = output_file.with_suffix(suffix)
+                            if old_imagefile.name != recipe.img:
+                                try:
+                                    old_imagefile.unlink()
+                                except FileNotFoundError:
+                                    pass
+        return recipe
     except CookbookException as ex:
         raise SourceException(str(file)) from ex
     except Exception as ex:
@@ -192,7 +304,7 @@ def process_file(file, output):
 
 def process_dir(input, output):
     """
-    Process an recipe directory.
+    List the recipe files of a directory.
     
     Parameters
     ----------
@@ -200,31 +312,121 @@ def process_dir(input, output):
         The path to de directory of recipes to process.
     output : pathlib.Path
         The path to the directory for the rendered files.
+
+    Returns a list of (file, output, image) tuples to give to process_file.
     """
-    for dirpath, dirnames, filenames in os.walk(input):
-        # build path to reflect the input directory structure
-        if output:
-            out = Path(output, input.name, Path(dirpath).relative_to(input))
-        for file in filenames:
-            if file.endswith('.yaml'):
-                pass
-                process_file(Path(dirpath, file), out)
+    jobs = []
+    # output paths reflect the input directory structure, each one is
+    # derived from its parent's rather than rebuilt from the input root
+    stack = [(input, Path(output, input.name) if output else None)]
+    while stack:
+        dirpath, out = stack.pop()
+        subdirs = []
+        recipes = []
+        names = set()
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((entry.path, out / entry.name if out else None))
+                else:
+                    names.add(entry.name)
+                    if entry.name.endswith('.yaml') and entry.is_file():
+                        recipes.append(entry)
+        # look for images in the listing rather than stat-ing each of them
+        for entry in recipes:
+            stem = entry.name[:-len('.yaml')]
+            image = next((stem + s for s in IMAGE_SUFFIXES if stem + s in names), None)
+            jobs.append((Path(entry.path), out, image))
+        # create each output directory once, before processing its files
+        if out and recipes:
+            out.mkdir(parents=True, exist_ok=True)
+        # keep the top-down, in-listing-order traversal of os.walk
+        stack.extend(reversed(subdirs))
+    return jobs
+
+
+def _process_job(job, force):
+    '''
+    Run process_file in a worker process.
+    Only the recipe summary is sent back to the main process. The exception
+    cause is lost on the way, so errors are returned as a (message,
+    traceback) pair instead.
+    '''
+    try:
+        recipe = process_file(*job, force)
+        return RecipeSummary(recipe.id, recipe.title, recipe.tags, recipe.groups), None
+    except SourceException as ex:
+        return None, (str(ex), traceback.format_exc())
+
+
+def _process_jobs(jobs, force):
+    '''
+    Run a chunk of jobs in a worker process, stopping at the first error.
+    '''
+    results = []
+    for job in jobs:
+        results.append(_process_job(job, force))
+        if results[-1][1]:
+            break
+    return results
 
 
+def _run_jobs(jobs, force):
+    '''
+    Yield the (summary, error) result of each job, in order.
+    Jobs are sent to worker processes by chunks; the chunks not started yet
+    are cancelled when the caller stops early, e.g. on the first error.
+    '''
+    workers = os.cpu_count() or 1
+    # fewer recipes than cpus are processed faster than workers start
+    if workers < 2 or len(jobs) < workers:
+        for job in jobs:
+            yield _process_job(job, force)
+        return
+
+    # a few chunks per worker, to balance the load between them, and no
+    # more workers than chunks
+    chunksize = max(1, len(jobs) // (4 * workers))
+    chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+    with ProcessPoolExecutor(min(workers, len(chunks))) as executor:
+        futures = [executor.submit(_process_jobs, chunk, force) for chunk in chunks]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+# compiled templates are kept on disk so that each worker process, and
+# each run, does not have to parse and compile them again; this is only an
+# optimization, skipped when the cache directory cannot be created
+try:
+    jinja_cache = Path('./.jinja-cache')
+    jinja_cache.mkdir(exist_ok=True)
+    bytecode_cache = FileSystemBytecodeCache(str(jinja_cache))
+except OSError:
+    bytecode_cache = None
+
 jinja_env = Environment(
-    loader = FileSystemLoader('./templates')
+    loader = FileSystemLoader('./templates'),
+    bytecode_cache = bytecode_cache,
+    auto_reload = False
 )
 
 recipe_template = jinja_env.get_template('recipe.jinja2')
 group_template = jinja_env.get_template('group.jinja2')
 
+# a template change makes every rendered recipe out of date
+recipe_template_mtime = os.stat(recipe_template.filename).st_mtime
+
 
 def recipe_to_rst(recipe, out_file):
-    out_file.write(recipe_template.render(recipe=recipe))
+    recipe_template.stream(recipe=recipe).dump(out_file)
 
 
 def group_to_rst(group, out_file):
-    out_file.write(group_template.render(group=group))
+    group_template.stream(group=group).dump(out_file)
 
 
 @click.command()
@@ -234,21 +436,35 @@ def group_to_rst(group, out_file):
 @click.option('--output', '-o',
     type=click.Path(exists=False),
     help='Set the output directory for the translated files. It activate the translation; if no output set, only validation is done.')
+@click.option('--force', '-f',
+    is_flag=True,
+    help='Render all the recipes, even the ones whose output is up to date.')
 @click.argument('inputs', nargs=-1, type=click.Path(exists=True))
-def main(inputs, output, verbose):
+def main(inputs, output, verbose, force):
     try:
-        # process all recipes files
+        # list all recipes files
+        if output:
+            Path(output).mkdir(parents=True, exist_ok=True)
+        jobs = []
         for p in [Path(i) for i in inputs]:
-            if p.is_dir():
-                process_dir(p, output)
-            elif p.is_file():
-                process_file(p, output)
-    
-    except SourceException as e:
-        print(f'[!]: {e!s}')
-        if verbose:
-            traceback.print_exc()
-        return 1
+            mode = p.stat().st_mode
+            if stat.S_ISDIR(mode):
+                jobs.extend(process_dir(p, output))
+            elif stat.S_ISREG(mode):
+                image = next((p.with_suffix(s).name for s in IMAGE_SUFFIXES if p.with_suffix(s).exists()), None)
+                jobs.append((p, output, image))
+
+        # process them in parallel, registering the recipes in order
+        with closing(_run_jobs(jobs, force)) as results:
+            for recipe, error in results:
+                if error:
+                    message, tb = error
+                    print(f'[!]: {message}')
+                    if verbose:
+                        sys.stderr.write(tb)
+                    return 1
+                register_recipe(recipe)
+
     except Exception as e:
         print(f"Error: {e!s}")
         if verbose: